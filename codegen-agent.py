@@ -1,16 +1,113 @@
 import os
 import json
+import asyncio
+import copy
+import hashlib
+import mmap
+import re
 import subprocess
+import sys
 import platform
+import shlex
 import shutil
-from typing import Dict, Any, List, Optional
-
-from openai import OpenAI, APIError
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple, Union, Callable, Set, TextIO
+
+import httpx
+import orjson
+from openai import AsyncOpenAI, APIError
 from dotenv import load_dotenv
 
+try:
+    import uvloop # Faster libuv-based event loop; optional and unavailable on Windows
+except ImportError:
+    uvloop = None
+
 load_dotenv()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_REQUESTS_PER_MINUTE = float(os.getenv("OPENROUTER_REQUESTS_PER_MINUTE", "60"))
 AGENT_MODEL = "openrouter/optimus-alpha"
+# Prompt-cache breakpoint marker (Anthropic-style, passed through by OpenRouter)
+CACHE_CONTROL = {"type": "ephemeral"}
+_DECODER = json.JSONDecoder()
+
+def _dumps(obj: Any) -> str:
+    """Serializes to compact JSON text with orjson (several times faster than json.dumps)."""
+    return orjson.dumps(obj).decode("utf-8")
+
+# Absolute paths of directories this process has already created or confirmed
+_KNOWN_DIRS: Set[str] = set()
+
+def _ensure_dir(dir_path: str) -> None:
+    """Creates a directory tree unless it is already known to exist."""
+    key = os.path.abspath(dir_path)
+    if key not in _KNOWN_DIRS:
+        os.makedirs(key, exist_ok=True)
+        _KNOWN_DIRS.add(key)
+
+def _forget_dirs(root: str) -> None:
+    """Drops a directory and everything below it from the known-directory cache."""
+    root = os.path.abspath(root)
+    prefix = root.rstrip(os.sep) + os.sep
+    for known in _KNOWN_DIRS.copy():
+        if known == root or known.startswith(prefix):
+            _KNOWN_DIRS.discard(known)
+
+def _open_in_dir(path: str, mode: str) -> TextIO:
+    """Opens a file for writing/appending, creating its parent directories if needed."""
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        _ensure_dir(dir_path)
+    try:
+        return open(path, mode, encoding="utf-8")
+    except FileNotFoundError:
+        if not dir_path:
+            raise
+        # The directory was removed outside these tools (e.g. via run_command); recreate it
+        _forget_dirs(dir_path)
+        _ensure_dir(dir_path)
+        return open(path, mode, encoding="utf-8")
+
+_WRITE_CHUNK_CHARS = 64 * 1024
+
+def _write_chunked(f: TextIO, content: str) -> None:
+    """Writes text in fixed-size slices so only one slice is encoded to bytes at a time."""
+    if len(content) <= _WRITE_CHUNK_CHARS:
+        f.write(content)
+        return
+    for start in range(0, len(content), _WRITE_CHUNK_CHARS):
+        f.write(content[start:start + _WRITE_CHUNK_CHARS])
+
+# Oversized tool outputs are saved here in full; only an excerpt goes into the conversation
+OBSERVATION_CACHE_DIR = os.path.join(".", ".agent_cache")
+
+def _content_digest(text: str) -> bytes:
+    """Short content hash identifying a tool output, for dedup and for naming its spill file."""
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+def _spill_observation(output: str, max_length: int) -> str:
+    """Writes an oversized tool output to disk and returns its head and tail with a pointer to the full file."""
+    excerpt_length = max_length * 2 // 5
+    # Named by content, so a repeated output reuses its file and yields an identical (dedupable) excerpt
+    path = os.path.join(OBSERVATION_CACHE_DIR, f"obs_{_content_digest(output).hex()}.txt")
+    try:
+        if not os.path.exists(path):
+            # Write then rename, so an interrupted write never leaves a partial file to be reused
+            with _open_in_dir(path + ".tmp", "w") as f:
+                _write_chunked(f, output)
+            os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"[TOOL ERROR] Could not save full tool output: {e}")
+        return output[:max_length] + "\n... (tool output truncated)"
+    return (
+        f"<truncated: {len(output)} chars, first {excerpt_length}>\n{output[:excerpt_length]}\n<...>\n"
+        f"<last {excerpt_length}>\n{output[-excerpt_length:]}\n"
+        f"[full content at {path}, use search_in_file to find the part you need]"
+    )
 
 def write_file(params: Dict[str, Any]) -> str:
     """Write content to a file. Creates parent directories if they don't exist."""
@@ -19,28 +116,83 @@ def write_file(params: Dict[str, Any]) -> str:
     if not path or content is None:
         return "Error: 'path' and 'content' are required."
     try:
-        dir_path = os.path.dirname(path)
-        if dir_path:
-            os.makedirs(dir_path, exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
+        with _open_in_dir(path, "w") as f:
+            _write_chunked(f, content)
         return f"File '{path}' written successfully."
     except Exception as e:
         return f"Error writing file '{path}': {e}"
 
+# Hard limit on one read_file result, whatever max_chars the LLM asks for; it bypasses the generic output cap
+READ_FILE_MAX_CHARS = 16384
+
 def read_file(params: Dict[str, Any]) -> str:
-    """Read the entire content from a specified file."""
+    """Read content from a specified file, stopping after 'max_chars' characters (at most READ_FILE_MAX_CHARS)."""
     path = params.get("path")
+    max_chars = min(params.get("max_chars", 8192), READ_FILE_MAX_CHARS)
     if not path:
         return "Error: 'path' is required."
+    if max_chars < 1:
+        return "Error: 'max_chars' must be at least 1."
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return f.read()
+            # Read one character past the cap to learn whether the file continues
+            data = f.read(max_chars + 1)
+        if len(data) > max_chars:
+            return data[:max_chars] + "\n... (file truncated, use search_in_file for targeted reads)"
+        return data
     except FileNotFoundError:
         return f"Error: File not found at '{path}'."
     except Exception as e:
         return f"Error reading file '{path}': {e}"
 
+# Characters that need a real shell (operators, redirection, expansion, env assignments, comments)
+_SHELL_CHARS = frozenset('&|;<>`$(){}[]*?~!#=\n')
+
+def _split_simple_command(command: str) -> Optional[List[str]]:
+    """Returns the argv for a command that can be spawned without a shell, or None if it needs one."""
+    if platform.system() == "Windows" or not _SHELL_CHARS.isdisjoint(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError: # e.g. unbalanced quotes; let the shell report it
+        return None
+    return argv or None
+
+# Bounds on captured command output: only the most recent lines of each stream are retained
+_MAX_CAPTURED_LINES = 200
+_MAX_CAPTURED_LINE_LENGTH = 4000
+
+def _drain_stream(stream, buffer: deque) -> None:
+    """Reads a pipe until EOF, keeping only the tail that fits in the bounded buffer."""
+    with stream:
+        for line in iter(lambda: stream.readline(_MAX_CAPTURED_LINE_LENGTH), ""):
+            buffer.append(line)
+
+def _run_captured(args: Union[str, List[str]], shell: bool) -> Tuple[int, str, str]:
+    """Runs a process and returns (exit code, stdout tail, stderr tail) using constant memory."""
+    process = subprocess.Popen(
+        args,
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace'
+    )
+    stdout_tail: deque = deque(maxlen=_MAX_CAPTURED_LINES)
+    stderr_tail: deque = deque(maxlen=_MAX_CAPTURED_LINES)
+    # One reader per pipe so neither can fill up and block the child
+    readers = [
+        threading.Thread(target=_drain_stream, args=(process.stdout, stdout_tail), daemon=True),
+        threading.Thread(target=_drain_stream, args=(process.stderr, stderr_tail), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    returncode = process.wait()
+    for reader in readers:
+        reader.join()
+    return returncode, "".join(stdout_tail), "".join(stderr_tail)
+
 def run_command(params: Dict[str, Any]) -> str:
     """Run a shell command in the *current* directory and return its exit code, stdout, and stderr."""
     command = params.get("command")
@@ -48,32 +200,31 @@ def run_command(params: Dict[str, Any]) -> str:
         return "Error: 'command' is required."
     try:
         print(f"[DEBUG] Running command: {command}")
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=False,
-            encoding='utf-8',
-            errors='replace',
-            cwd=os.getcwd()
-        )
-        output = f"Exit Code: {result.returncode}\n"
-        if result.stdout:
-            output += f"STDOUT:\n{result.stdout.strip()}\n"
+        argv = _split_simple_command(command)
+        result = None
+        if argv:
+            try:
+                # Spawn directly and skip the /bin/sh fork for plain invocations
+                result = _run_captured(argv, shell=False)
+            except FileNotFoundError:
+                pass # Not an executable (e.g. a shell builtin like 'cd'); nothing ran, so retry via the shell
+        if result is None:
+            result = _run_captured(command, shell=True)
+        returncode, stdout, stderr = result
+        output = f"Exit Code: {returncode}\n"
+        if stdout:
+            output += f"STDOUT:\n{stdout.strip()}\n"
         else:
             output += "STDOUT: (empty)\n"
-        if result.stderr:
-            output += f"STDERR:\n{result.stderr.strip()}\n"
+        if stderr:
+            output += f"STDERR:\n{stderr.strip()}\n"
         else:
              output += "STDERR: (empty)\n"
 
-        if result.returncode != 0:
-             output += f"\n[INFO] Command execution may have failed (non-zero exit code: {result.returncode}). Review STDERR."
+        if returncode != 0:
+             output += f"\n[INFO] Command execution may have failed (non-zero exit code: {returncode}). Review STDERR."
 
-        max_output_length = 4000
-        if len(output) > max_output_length:
-             output = output[:max_output_length] + "\n... (output truncated)"
+        # Long output is cut down (and saved in full) centrally by CodingAgent._execute_tool
 
         return output.strip()
     except Exception as e:
@@ -87,10 +238,15 @@ def run_in_new_terminal(params: Dict[str, Any]) -> str:
     if platform.system() != "Darwin":
         return "Error: run_in_new_terminal only works on macOS. Use run_command instead."
     try:
-        safe_command = command.replace('\\', '\\\\').replace('"', '\\"')
-        script = f'''osascript -e 'tell application "Terminal" to do script "{safe_command}" activate' '''
+        # A JSON string body is a valid AppleScript string literal body (quotes, backslashes, newlines escaped)
+        safe_command = json.dumps(command, ensure_ascii=False)[1:-1]
+        script = [
+            "osascript",
+            "-e", f'tell application "Terminal" to do script "{safe_command}"',
+            "-e", 'tell application "Terminal" to activate',
+        ]
         print(f"[DEBUG] Running in new terminal: {script}")
-        subprocess.run(script, shell=True, check=True)
+        subprocess.run(script, check=True)
         return f"Command '{command}' launched in a new Terminal window. Note: It runs independently and starts in the user's home directory unless the command includes 'cd'."
     except Exception as e:
         return f"Error running command '{command}' in new terminal: {e}"
@@ -102,11 +258,8 @@ def append_file(params: Dict[str, Any]) -> str:
     if not path or content is None:
         return "Error: 'path' and 'content' are required."
     try:
-        dir_path = os.path.dirname(path)
-        if dir_path:
-             os.makedirs(dir_path, exist_ok=True)
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(content)
+        with _open_in_dir(path, "a") as f:
+            _write_chunked(f, content)
         return f"Content appended to '{path}'."
     except Exception as e:
         return f"Error appending to file '{path}': {e}"
@@ -115,16 +268,16 @@ def list_files(params: Dict[str, Any]) -> str:
     """List all files and directories within a specified directory."""
     directory = params.get("directory", ".")
     try:
-        entries = os.listdir(directory)
         detailed_entries = []
-        for entry in entries:
-            try:
-                entry_path = os.path.join(directory, entry)
-                is_dir = os.path.isdir(entry_path)
-                detailed_entries.append({"name": entry, "type": "directory" if is_dir else "file"})
-            except OSError:
-                detailed_entries.append({"name": entry, "type": "unknown/inaccessible"})
-        return json.dumps(detailed_entries)
+        # scandir entries carry the file type from the directory read, avoiding a stat per entry
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    detailed_entries.append({"name": entry.name, "type": "directory" if is_dir else "file"})
+                except OSError:
+                    detailed_entries.append({"name": entry.name, "type": "unknown/inaccessible"})
+        return _dumps(detailed_entries)
     except FileNotFoundError:
         return f"Error: Directory not found at '{directory}'."
     except Exception as e:
@@ -134,20 +287,51 @@ def search_in_file(params: Dict[str, Any]) -> str:
     """Search for a specific string within a file and return matching lines with line numbers."""
     path = params.get("path")
     query = params.get("query")
+    max_matches = params.get("max_matches", 50)
     if not path or not query:
         return "Error: 'path' and 'query' are required."
+    if max_matches < 1:
+        return "Error: 'max_matches' must be at least 1."
     try:
         matches = []
-        with open(path, "r", encoding="utf-8", errors='replace') as f:
-            for i, line in enumerate(f):
-                if query in line:
-                    matches.append({"line_number": i + 1, "content": line.strip()})
+        remaining = 0
+        needle = query.encode("utf-8")
+        with open(path, "rb") as f:
+            # Empty files cannot be mapped and have nothing to match
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # Jump between occurrences in C and only decode the lines that match
+                    pos = 0
+                    line_number = 1
+                    counted_to = 0
+                    while True:
+                        match_pos = mm.find(needle, pos)
+                        if match_pos == -1:
+                            break
+                        if len(matches) >= max_matches:
+                            # Stop collecting; only count the matching lines left for the truncation notice,
+                            # hopping line to line in the mapping instead of copying the rest of the file
+                            while match_pos != -1:
+                                remaining += 1
+                                line_end = mm.find(b"\n", match_pos)
+                                if line_end == -1:
+                                    break
+                                match_pos = mm.find(needle, line_end + 1)
+                            break
+                        line_start = mm.rfind(b"\n", 0, match_pos) + 1
+                        line_end = mm.find(b"\n", match_pos)
+                        if line_end == -1:
+                            line_end = len(mm)
+                        line_number += mm[counted_to:line_start].count(b"\n")
+                        counted_to = line_start
+                        line = mm[line_start:line_end].decode("utf-8", errors="replace")
+                        matches.append({"line_number": line_number, "content": line.strip()})
+                        pos = line_end + 1
         if not matches:
             return f"No matches found for '{query}' in file '{path}'."
-        max_matches = 50
-        if len(matches) > max_matches:
-             return json.dumps(matches[:max_matches]) + f"\n... (truncated, {len(matches) - max_matches} more matches found)"
-        return json.dumps(matches)
+        if remaining:
+             return _dumps(matches) + f"\n... (truncated, {remaining} more matching lines found)"
+        return _dumps(matches)
     except FileNotFoundError:
         return f"Error: File not found at '{path}'."
     except Exception as e:
@@ -175,6 +359,7 @@ def create_directory(params: Dict[str, Any]) -> str:
         return "Error: 'directory' is required."
     try:
         os.makedirs(directory, exist_ok=True)
+        _KNOWN_DIRS.add(os.path.abspath(directory))
         return f"Directory '{directory}' created or already exists."
     except Exception as e:
         return f"Error creating directory '{directory}': {e}"
@@ -195,6 +380,9 @@ def delete_directory(params: Dict[str, Any]) -> str:
         return f"Directory '{directory}' and its contents deleted successfully."
     except Exception as e:
         return f"Error deleting directory '{directory}': {e}"
+    finally:
+        # Even a partial rmtree may have removed cached directories
+        _forget_dirs(directory)
 
 def ask_user_for_feedback(params: Dict[str, Any]) -> str:
     """Pause execution and ask the human user a clarifying question. Returns the user's response."""
@@ -211,6 +399,142 @@ def ask_user_for_feedback(params: Dict[str, Any]) -> str:
     except Exception as e:
         return f"Error getting user input: {e}"
 
+# Operations accepted by batch_file_ops, mapped to the single-operation tools
+_BATCH_FILE_OPS = {
+    "write": write_file,
+    "append": append_file,
+    "read": read_file,
+    "list": list_files,
+    "search": search_in_file,
+    "delete": delete_file,
+    "create_directory": create_directory,
+}
+_READ_ONLY_BATCH_OPS = frozenset({"read", "list", "search"})
+_FILE_IO_WORKERS = 8
+_file_io_executor: Optional[ThreadPoolExecutor] = None
+_file_io_executor_lock = threading.Lock()
+
+def _get_file_io_executor() -> ThreadPoolExecutor:
+    """Returns the process-wide file I/O pool, creating it on first use."""
+    global _file_io_executor
+    if _file_io_executor is None:
+        with _file_io_executor_lock:
+            if _file_io_executor is None:
+                _file_io_executor = ThreadPoolExecutor(max_workers=_FILE_IO_WORKERS, thread_name_prefix="file-io")
+    return _file_io_executor
+
+def _run_batch_op(op: Dict[str, Any]) -> Dict[str, Any]:
+    """Executes one batch_file_ops entry and returns its result record."""
+    op_name = op.get("op")
+    target = op.get("path", op.get("directory"))
+    op_fn = _BATCH_FILE_OPS.get(op_name)
+    if op_fn is None:
+        result = f"Error: Unknown op '{op_name}'. Allowed ops: {', '.join(_BATCH_FILE_OPS)}."
+    else:
+        try:
+            result = op_fn(op)
+        except Exception as e:
+            result = f"Error executing op '{op_name}': {e}"
+    return {"op": op_name, "target": target, "result": result}
+
+def _targets_disjoint(ops: List[Dict[str, Any]]) -> bool:
+    """True if no two ops touch the same file or directory, or one inside the other, however the paths are spelled."""
+    raw_targets = [op.get("path", op.get("directory", ".")) for op in ops]
+    if not all(isinstance(target, str) for target in raw_targets):
+        return False # Let each op report its own error, in order
+    targets = [os.path.realpath(target) for target in raw_targets]
+    unique = set(targets)
+    if len(unique) != len(targets):
+        return False
+    for target in targets:
+        parent = os.path.dirname(target)
+        while parent != target:
+            if parent in unique:
+                return False
+            target, parent = parent, os.path.dirname(parent)
+    return True
+
+def batch_file_ops(params: Dict[str, Any]) -> str:
+    """Execute a list of file operations in one call and return their results in order."""
+    ops = params.get("ops")
+    if not ops:
+        return "Error: 'ops' is required and must be a non-empty list."
+    if not all(isinstance(op, dict) for op in ops):
+        return "Error: every entry in 'ops' must be an object."
+    read_only = all(op.get("op") in _READ_ONLY_BATCH_OPS for op in ops)
+    independent = not any(op.get("op") == "list" for op in ops) and _targets_disjoint(ops)
+    if len(ops) > 1 and (read_only or independent):
+        # No op can observe another's effects, so overlap the blocking syscalls on the shared pool
+        results = list(_get_file_io_executor().map(_run_batch_op, ops))
+    else:
+        results = [_run_batch_op(op) for op in ops]
+    return _dumps(results)
+
+
+# JSON schema type name -> Python type(s) accepted for it
+_SCHEMA_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
+
+def _has_type(value: Any, expected_type: str) -> bool:
+    """Checks a decoded JSON value against a schema type name."""
+    # bool is an int subclass, but JSON keeps the two apart
+    return isinstance(value, _SCHEMA_TYPES[expected_type]) and (expected_type == "boolean" or not isinstance(value, bool))
+
+def _compile_validator(parameters: Dict[str, Any], noun: str = "parameter") -> Callable[[Dict[str, Any]], Optional[str]]:
+    """Compiles an object schema (tool parameters or an agent step) into a checker that returns an error message or None."""
+    required = tuple(parameters.get("required", []))
+    properties = parameters.get("properties", {})
+    type_checks = tuple(
+        (name, spec["type"])
+        for name, spec in properties.items()
+        if spec.get("type") in _SCHEMA_TYPES
+    )
+    enum_checks = tuple(
+        (name, frozenset(spec["enum"]), ", ".join(f"'{option}'" for option in spec["enum"]))
+        for name, spec in properties.items()
+        if "enum" in spec
+    )
+    # Arrays with an "items" schema: object items get their own compiled checker, others a type check
+    item_checks = tuple(
+        (
+            name,
+            spec["items"].get("type"),
+            _compile_validator(spec["items"], noun) if spec["items"].get("type") == "object" else None,
+        )
+        for name, spec in properties.items()
+        if spec.get("type") == "array" and spec.get("items", {}).get("type") in _SCHEMA_TYPES
+    )
+
+    def validate(function_input: Dict[str, Any]) -> Optional[str]:
+        for param in required:
+            if param not in function_input:
+                return f"Missing required {noun} '{param}'"
+        for name, expected_type in type_checks:
+            if name in function_input:
+                value = function_input[name]
+                if not _has_type(value, expected_type):
+                    return f"Invalid type for {noun} '{name}' (expected {expected_type}, got {type(value).__name__})"
+        for name, allowed, allowed_text in enum_checks:
+            if name in function_input and function_input[name] not in allowed:
+                return f"Invalid value for {noun} '{name}' (expected one of {allowed_text}, got {function_input[name]!r})"
+        for name, item_type, item_validator in item_checks:
+            for index, item in enumerate(function_input.get(name, ())):
+                if not _has_type(item, item_type):
+                    return f"Invalid item {index} in {noun} '{name}' (expected {item_type}, got {type(item).__name__})"
+                if item_validator is not None:
+                    error = item_validator(item)
+                    if error:
+                        return f"Invalid item {index} in {noun} '{name}': {error}"
+        return None
+
+    return validate
+
 
 AVAILABLE_TOOLS = {
     "write_file": {
@@ -227,14 +551,17 @@ AVAILABLE_TOOLS = {
     },
     "read_file": {
         "fn": read_file,
-        "description": "Read the entire content from a specified file.",
+        "description": "Read the content from a specified file. Large files are truncated; use search_in_file to locate specific content.",
         "parameters": {
             "type": "object",
             "properties": {
-                "path": {"type": "string", "description": "The path to the file to be read."}
+                "path": {"type": "string", "description": "The path to the file to be read."},
+                "max_chars": {"type": "integer", "description": f"Maximum number of characters to return. Defaults to 8192, at most {READ_FILE_MAX_CHARS}."}
             },
             "required": ["path"]
-        }
+        },
+        "max_output_length": None, # read_file applies its own cap
+        "speculative_safe": True # No side effects, so it may start before the response is validated
     },
     "run_command": {
         "fn": run_command,
@@ -290,7 +617,8 @@ AVAILABLE_TOOLS = {
                 "directory": {"type": "string", "description": "The path to the directory whose contents should be listed. Defaults to current directory '.' if omitted."}
             },
             "required": []
-        }
+        },
+        "speculative_safe": True
     },
     "search_in_file": {
         "fn": search_in_file,
@@ -299,10 +627,12 @@ AVAILABLE_TOOLS = {
             "type": "object",
             "properties": {
                 "path": {"type": "string", "description": "The path to the file to search within."},
-                "query": {"type": "string", "description": "The string pattern to search for."}
+                "query": {"type": "string", "description": "The string pattern to search for."},
+                "max_matches": {"type": "integer", "description": "Maximum number of matching lines to return. Defaults to 50."}
             },
             "required": ["path", "query"]
-        }
+        },
+        "speculative_safe": True
     },
     "delete_file": {
         "fn": delete_file,
@@ -336,9 +666,25 @@ AVAILABLE_TOOLS = {
             },
             "required": ["directory"]
         }
+    },
+    "batch_file_ops": {
+        "fn": batch_file_ops,
+        "description": "Execute several file operations in a single call. Each op is an object with an 'op' field ('write', 'append', 'read', 'list', 'search', 'delete', 'create_directory') plus the parameters of the matching single tool (e.g. 'path', 'content', 'query', 'directory'). Ops run in order unless they are independent. Returns a JSON list of results.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "ops": {"type": "array", "description": "List of operations, e.g. [{\"op\": \"write\", \"path\": \"a.txt\", \"content\": \"...\"}, {\"op\": \"read\", \"path\": \"b.txt\"}]."}
+            },
+            "required": ["ops"]
+        },
+        "max_output_length": 20000 # Results of several ops, each already bounded by its own tool
     }
 }
 
+# Validators are compiled once here; custom tool sets are compiled when an agent is created
+for _tool_info in AVAILABLE_TOOLS.values():
+    _tool_info["_validator"] = _compile_validator(_tool_info["parameters"])
+
 
 def generate_system_prompt(tools: Dict[str, Any]) -> str:
     """Generates the system prompt including formatted tool descriptions and handling for pathing and user feedback."""
@@ -349,14 +695,15 @@ def generate_system_prompt(tools: Dict[str, Any]) -> str:
             "parameters": tool_info["parameters"]
         }
 
-    formatted_tools = json.dumps(tool_descriptions, indent=2)
+    # Compact separators: the schema is sent with every request, and indentation only costs tokens
+    formatted_tools = json.dumps(tool_descriptions, separators=(',', ':'))
     personalization_hints = "The user often works with React and Java Spring Boot, and enjoys competitive coding (Python, C++, Java)."
 
     return f'''
 You are a highly capable AI Coding Agent with file system and terminal access, designed to work across various programming languages and frameworks. {personalization_hints} For any user request, follow this workflow meticulously:
 
 1.  **Plan:** Briefly state your plan. Outline the steps, including the specific shell commands. Critically identify commands that start long-running processes (like web servers) and commands that need to run in specific directories. Determine if user clarification is needed.
-2.  **Act:** Execute steps sequentially using *only* the available tools, one tool per action.
+2.  **Act:** Execute steps sequentially using *only* the available tools, one tool per action. When several tool calls are independent of each other, you may issue them together in one "actions" step.
 3.  **Observe:** After each action, you receive the tool's output (or user response).
 4.  **Analyze & Iterate:** Carefully analyze the observation. Check for errors, extract needed information (like paths from `pwd`). If unsure or before destructive actions, consider using `ask_user_for_feedback`. Adjust plan if needed.
 5.  **Output:** Once the request is fully addressed, provide the final result/confirmation. If a server was started, mention how to access it.
@@ -373,6 +720,7 @@ You are a highly capable AI Coding Agent with file system and terminal access, d
     *   Assume launch succeeded if no *immediate* tool error occurs. The agent won't get further output from this separate terminal.
     *   After launching, usually proceed directly to the final "output" step.
 *   **`ask_user_for_feedback`:** Use this tool **sparingly** when you genuinely need clarification, confirmation (e.g., before `delete_directory`), or input from the user that wasn't in the original request. Frame clear, concise questions. The tool pauses execution until the user responds.
+*   **`batch_file_ops`:** When you need several file operations that don't depend on each other's results (scaffolding multiple files, reading a set of files), submit them together in one `batch_file_ops` call instead of one action per file.
 *   **File Paths:** Be precise with relative and absolute paths. Use `pwd` if unsure about the current location before constructing paths.
 *   **JSON Output:** Adhere strictly to the specified JSON format for *every* response.
 *   **Error Handling:** Check `run_command` output. Diagnose errors and try to fix them (e.g., install missing dependencies, correct syntax).
@@ -383,16 +731,20 @@ You are a highly capable AI Coding Agent with file system and terminal access, d
 
 **OUTPUT JSON FORMAT:**
 {{
-  "step": "string",  // Must be one of: "plan", "action", "observe", "output"
+  "step": "string",  // Must be one of: "plan", "action", "actions", "plan_dag", "observe", "output"
   "content": "string",  // Plan description, analysis, reasoning, or final user message.
   "function": "string",  // Tool name. Required only for step="action".
-  "input": {{}}      // Tool parameters object. Required only for step="action".
+  "input": {{}},     // Tool parameters object. Required only for step="action".
+  "calls": [],       // List of {{"function": ..., "input": {{...}}}} objects. Required only for step="actions".
+  "nodes": []        // List of {{"id": ..., "function": ..., "input": {{...}}, "deps": [...]}} objects. Required only for step="plan_dag".
 }}
 
 **STEP DESCRIPTIONS:**
 *   `plan`: Outline strategy, commands, path considerations, potential user questions.
 *   `action`: Specify the *single* tool call (`run_command`, `run_in_new_terminal`, `ask_user_for_feedback`, file ops, etc.).
-*   `observe`: (Input from System) Provides the result/output from the executed tool or user response.
+*   `actions`: Specify several *independent* tool calls in `calls`; they may run concurrently, so none may depend on another's result. The observation lists each call's output in order.
+*   `plan_dag`: Specify a graph of tool calls in `nodes` when some calls depend on others. Each node has a unique `id`, a `function`, an `input` and `deps` (ids that must finish first). A node starts as soon as its deps are done; use `{{<id>.result}}` inside an input string to insert the output of a node listed in `deps`. The observation lists each node's output.
+*   `observe`: (Input from System) Provides the result/output from the executed tool or user response. Each tool output carries an `observation` number; if an output is exactly the same as an earlier one, it is replaced by `<identical to observation #N>` — refer back to observation N instead of re-running the tool.
 *   `output`: Present the final response/result to the user.
 
 **EXAMPLE 1: React Dev Server (Handling Path)**
@@ -504,112 +856,710 @@ User: "Delete the 'temp-project' directory."
 '''
 
 
+COMPACTION_PROMPT = (
+    "You compress the working history of an AI coding agent. The input is a sequence of JSON steps "
+    "(plan, action, observe). Summarize it in at most 15 short bullet lines: what was attempted, which "
+    "tools were called with which key arguments, important results (paths, errors, versions, file "
+    "contents that matter later) and what is still pending. Output only the bullet lines."
+)
+
+# The default tool set never changes at runtime, so its prompt is built once at import.
+SYSTEM_PROMPT = generate_system_prompt(AVAILABLE_TOOLS)
+
+AGENT_STEPS = ("plan", "action", "actions", "plan_dag", "observe", "output")
+
+_TOOL_CALL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "function": {"type": "string"},
+        "input": {"type": "object"},
+    },
+    "required": ["function", "input"],
+}
+
+# Shape of one agent response, sent as a structured-output schema so supporting providers
+# can only generate valid steps; providers without support fall back to plain JSON mode
+AGENT_STEP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "step": {"type": "string", "enum": list(AGENT_STEPS)},
+        "content": {"type": "string"},
+        "function": {"type": "string"},
+        "input": {"type": "object"},
+        "calls": {"type": "array", "items": _TOOL_CALL_SCHEMA},
+        "nodes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "function": {"type": "string"},
+                    "input": {"type": "object"},
+                    "deps": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["id", "function", "input"],
+            },
+        },
+    },
+    "required": ["step"],
+}
+
+AGENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "agent_step", "strict": False, "schema": AGENT_STEP_SCHEMA},
+}
+
+# Fields a step must carry beyond 'step' itself
+_STEP_REQUIRED_FIELDS = {
+    "action": ("function", "input"),
+    "actions": ("calls",),
+    "plan_dag": ("nodes",),
+}
+
+def _compile_step_validator(schema: Dict[str, Any]) -> Callable[[Dict[str, Any]], Optional[str]]:
+    """Compiles the agent step schema plus each step's required fields into one checker for parsed LLM output."""
+    check_fields = _compile_validator(schema, noun="field")
+    step_checks = {
+        step: _compile_validator({"required": list(fields)}, noun="field")
+        for step, fields in _STEP_REQUIRED_FIELDS.items()
+    }
+
+    def validate(parsed_output: Dict[str, Any]) -> Optional[str]:
+        error = check_fields(parsed_output)
+        if error is None and parsed_output["step"] in step_checks:
+            error = step_checks[parsed_output["step"]](parsed_output)
+            if error:
+                error = f"Malformed '{parsed_output['step']}' step: {error}"
+        return error
+
+    return validate
+
+_validate_agent_step = _compile_step_validator(AGENT_STEP_SCHEMA)
+
+
+class _AsyncRateLimiter:
+    """Token bucket allowing `rate` acquisitions per `period` seconds across every agent in the process."""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = rate
+        self._updated = time.monotonic()
+        # asyncio.Lock binds to the loop that first waits on it, so one is made per event loop
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def acquire(self) -> None:
+        """Waits until a request may be sent."""
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+
+_OPENROUTER_RATE_LIMITER = _AsyncRateLimiter(OPENROUTER_REQUESTS_PER_MINUTE)
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Returns the pooled HTTP/2 client of the running event loop, so agents reuse warm TLS connections."""
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    # Pooled connections belong to the loop that opened them; a new asyncio.run() needs a new pool
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client_loop = loop
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=60,
+        )
+    return _http_client
+
+
+# "{<node id>.result}" placeholders in plan_dag node inputs
+_DAG_PLACEHOLDER = re.compile(r"\{([\w\-]+)\.result\}")
+
+def _fill_placeholders(value: Any, results: Dict[str, str]) -> Any:
+    """Substitutes finished dependency outputs into the string values of a node's input."""
+    if isinstance(value, str):
+        return _DAG_PLACEHOLDER.sub(lambda match: results.get(match.group(1), match.group(0)), value)
+    if isinstance(value, dict):
+        return {key: _fill_placeholders(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill_placeholders(item, results) for item in value]
+    return value
+
+def _placeholder_ids(value: Any) -> Set[str]:
+    """Collects the node ids referenced by "{<id>.result}" placeholders anywhere in a node's input."""
+    if isinstance(value, str):
+        return set(_DAG_PLACEHOLDER.findall(value))
+    if isinstance(value, dict):
+        return set().union(*(_placeholder_ids(item) for item in value.values()))
+    if isinstance(value, list):
+        return set().union(*(_placeholder_ids(item) for item in value))
+    return set()
+
+
+# Characters the scanner must stop at inside and outside JSON string literals
+_JSON_STRING_SPECIALS = re.compile(r'["\\]')
+_JSON_STRUCTURAL = re.compile(r'[{}"]')
+
+
+class _JsonObjectScanner:
+    """Tracks brace depth across streamed chunks to detect when the first top-level JSON object closes."""
+
+    def __init__(self):
+        self.complete = False
+        self.member_end = -1 # Offset just past the latest nested value closed at the top level
+        self._offset = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        """Scans the next chunk of the response. Returns True once the object is complete."""
+        if self.complete:
+            return True
+        base = self._offset
+        self._offset += len(chunk)
+        pos = 0
+        if not self._started:
+            pos = chunk.find('{')
+            if pos == -1:
+                return False
+            self._started = True
+            self._depth = 1
+            pos += 1
+        # Regex searches jump straight to the next significant character, so the
+        # per-character work happens in C rather than in a Python loop
+        length = len(chunk)
+        while pos < length:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    pos += 1
+                    continue
+                match = _JSON_STRING_SPECIALS.search(chunk, pos)
+                if match is None:
+                    return False
+                pos = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                else:
+                    self._escaped = True # May carry over into the next chunk
+                continue
+            match = _JSON_STRUCTURAL.search(chunk, pos)
+            if match is None:
+                return False
+            pos = match.end()
+            ch = match.group()
+            if ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 1:
+                    self.member_end = base + pos
+                elif self._depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+
+_STEP_VALUE = re.compile(r'"step"\s*:\s*"(\w*)"')
+_CONTENT_KEY = re.compile(r'"content"\s*:\s*"')
+# Longest prefix of a JSON string body that holds only complete characters and escapes
+_JSON_STRING_BODY = re.compile(r'(?:[^"\\]+|\\u[0-9a-fA-F]{4}|\\[^u])*')
+_TRAILING_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+_KEY_OVERLAP = 32 # Re-scan this much of the previous text so keys split across chunks are still found
+
+
+class _OutputContentStreamer:
+    """Echoes the "content" string of a streamed "output" step to stdout while the rest of the response arrives."""
+
+    def __init__(self, out: TextIO = sys.stdout):
+        self.started = False # True once any of the final answer has been written
+        self._out = out
+        self._buffer = ""
+        self._scanned = 0
+        self._step: Optional[str] = None
+        self._content_pos = -1 # Offset of the next unwritten character inside the content string
+        self._done = False
+
+    def feed(self, chunk: str) -> None:
+        """Adds the next chunk of the response and writes any newly completed part of the final answer."""
+        if self._done:
+            return
+        self._buffer += chunk
+        scan_from = max(0, self._scanned - _KEY_OVERLAP)
+        self._scanned = len(self._buffer)
+        if self._step is None:
+            match = _STEP_VALUE.search(self._buffer, scan_from)
+            if match is None:
+                return
+            self._step = match.group(1)
+            if self._step != "output":
+                self._done = True # Not a final answer; nothing to echo
+                self._buffer = ""
+                return
+            scan_from = 0 # "content" may have been streamed before "step"
+        if self._content_pos == -1:
+            match = _CONTENT_KEY.search(self._buffer, scan_from)
+            if match is None:
+                return
+            self._content_pos = match.end()
+            self.started = True
+            self._out.write("\n[FINAL OUTPUT]\n")
+        body = _JSON_STRING_BODY.match(self._buffer, self._content_pos)
+        end = body.end()
+        closed = end < len(self._buffer) and self._buffer[end] == '"'
+        if not closed:
+            # Hold back half of a surrogate pair until its partner arrives
+            held = _TRAILING_HIGH_SURROGATE.search(self._buffer, self._content_pos, end)
+            if held is not None:
+                end = held.start()
+        if end > self._content_pos:
+            self._out.write(json.loads('"' + self._buffer[self._content_pos:end] + '"'))
+            self._out.flush()
+            self._content_pos = end
+        if closed:
+            self._out.write("\n")
+            self._out.flush()
+            self._done = True
+
+
+# Stands in for a tool output identical to an earlier, numbered observation
+_OBSERVATION_POINTER = re.compile(r"<identical to observation #(\d+)>")
+
+
 class CodingAgent:
-    def __init__(self, model: str = AGENT_MODEL, tools: Dict[str, Any] = AVAILABLE_TOOLS):
+    def __init__(self, model: str = AGENT_MODEL, tools: Dict[str, Any] = AVAILABLE_TOOLS, stream: bool = True):
         if not OPENROUTER_API_KEY:
             raise ValueError("OPENROUTER_API_KEY environment variable not set.")
 
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=OPENROUTER_API_KEY,
-        )
+        # The API client is created lazily for each event loop (see the client property)
+        self._client: Optional[AsyncOpenAI] = None
+        self._client_http: Optional[httpx.AsyncClient] = None
         self.model = model
         self.tools = tools
-        # Ensure the __init__ method calls the updated prompt generator
-        self.system_prompt = generate_system_prompt(tools)
+        # Resolve everything _execute_tool needs per tool once: (function, is coroutine, validator, output cap)
+        self._dispatch: Dict[str, Tuple[Callable[[Dict[str, Any]], Any], bool, Callable[[Dict[str, Any]], Optional[str]], Optional[int]]] = {
+            name: (
+                tool_info["fn"],
+                asyncio.iscoroutinefunction(tool_info["fn"]),
+                tool_info.get("_validator") or _compile_validator(tool_info["parameters"]),
+                tool_info.get("max_output_length", 5000),
+            )
+            for name, tool_info in tools.items()
+        }
+        # Only tools without side effects may run before their action step has been validated
+        self._speculative_tools = frozenset(name for name, tool_info in tools.items() if tool_info.get("speculative_safe"))
+        # Reuse the prebuilt prompt for the default tool set; only custom tool sets pay for generation
+        self.system_prompt = SYSTEM_PROMPT if tools is AVAILABLE_TOOLS else generate_system_prompt(tools)
         self.messages: List[Dict[str, str]] = [{"role": "system", "content": self.system_prompt}]
+        # The system prompt never changes for an agent, so its request form and digest are built once
+        self._system_request_message = self._with_cache_control(self.messages[0])
+        self._system_prompt_digest = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()
         self.max_iterations = 25 # Increased slightly for potential user feedback loops
+        self.stream = stream # Stop reading the response as soon as the JSON object is complete
+        self.stream_final_output = stream # Print the final answer as it is generated
+        self._final_output_streamed = False # Whether the latest response's answer was already printed
+        self.max_context_tokens = 20000 # Past 70% of this (estimated), older turns are summarized
+        self.keep_recent_messages = 3 # Always sent verbatim so the LLM keeps its immediate context
+        self.min_compaction_tokens = 4000 # Compacting less history than this is not worth a summarization call
+        self.compact_after_iterations = 15 # Past this, a summarized prefix is cheaper than keeping the cached one
+        self.enable_parallel_tool_execution = True # Run the calls of an "actions" step concurrently
+        self.enable_speculative_tool_execution = True # Start a streamed action's tool as soon as its input is complete
+        self._speculative_call: Optional[Tuple[str, Dict[str, Any], asyncio.Task]] = None
+        self._last_step: Optional[str] = None # Step of the most recent assistant turn
+        # Content digest -> observation number, so repeated tool outputs are sent only once per interaction
+        self._obs_hashes: Dict[bytes, int] = {}
+        self._obs_texts: Dict[int, str] = {} # Observation number -> full text, for outputs that can be pointed to
+        self._observation_count = 0
+        self.temperature = 0.5 # Keep temp reasonable for reliable tool use
+        self.response_format: Dict[str, Any] = AGENT_RESPONSE_FORMAT # Use {"type": "json_object"} for providers that reject schemas
+        # Exact-match cache of validated responses; only consulted for deterministic (temperature 0) calls
+        self.enable_response_cache = True
+        self._response_cache: Dict[str, str] = {}
+        self.cache_stats = {"hits": 0, "misses": 0}
+        # Open the connection (DNS, TCP, TLS, HTTP/2) in the background while the user types the first query
+        self._warm_up_task: Optional[asyncio.Task] = None
+        try:
+            self._warm_up_task = asyncio.get_running_loop().create_task(self._warm_up_connection())
+        except RuntimeError:
+            pass # Created outside an event loop; the first request opens the connection instead
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """The API client bound to the running event loop's shared HTTP/2 pool."""
+        http_client = _get_http_client()
+        if self._client is None or self._client_http is not http_client:
+            self._client = AsyncOpenAI(
+                base_url=OPENROUTER_BASE_URL,
+                api_key=OPENROUTER_API_KEY,
+                http_client=http_client,
+                max_retries=5, # Exponential backoff on 429/5xx and connection errors
+            )
+            self._client_http = http_client
+        return self._client
 
-    def _call_llm(self) -> Optional[Dict[str, Any]]:
-        """Calls the LLM, handles potential errors, and parses JSON response."""
-        print(f"\n[DEBUG] Sending {len(self.messages)} messages to LLM (model: {self.model}). Last message role: {self.messages[-1]['role']}")
+    async def _warm_up_connection(self) -> None:
+        """Sends a tiny request to the API host so the pooled connection is ready for the first LLM call."""
+        try:
+            await _get_http_client().head(f"{OPENROUTER_BASE_URL.rstrip('/')}/models", timeout=10)
+        except httpx.HTTPError as e:
+            print(f"[DEBUG] Connection warm-up failed (the first request will connect instead): {e}")
 
+    @staticmethod
+    def _summarize_message(message: Dict[str, str], preview_length: int = 200) -> str:
+        """Reduces one history entry to a single short line for the rolling summary."""
         try:
-            response = self.client.chat.completions.create(
+            entry = orjson.loads(message["content"])
+        except json.JSONDecodeError:
+            entry = None
+        if not isinstance(entry, dict):
+            return f"- {message['role']}: {message['content'][:preview_length]}"
+        if entry.get("summary"):
+            return entry["content"].split("\n", 1)[-1] # An earlier summary: reuse its lines without the header
+        step = entry.get("step")
+        if step == "action":
+            tool_input = _dumps(entry.get("input"))
+            return f"- action: {entry.get('function')}({tool_input[:preview_length]})"
+        content = str(entry.get("content", ""))
+        if len(content) > preview_length:
+            content = f"{content[:preview_length]}... ({len(content)} chars)"
+        return f"- {step}: {content}"
+
+    def _record_observation(self, output: str) -> Tuple[int, str]:
+        """Numbers a tool output; returns a pointer instead of the text if an identical output was already sent."""
+        self._observation_count += 1
+        if len(output) < 64: # Short outputs cost about as much as the pointer
+            return self._observation_count, output
+        digest = _content_digest(output)
+        previous = self._obs_hashes.get(digest)
+        if previous is not None:
+            return self._observation_count, f"<identical to observation #{previous}>"
+        self._obs_hashes[digest] = self._observation_count
+        self._obs_texts[self._observation_count] = output
+        return self._observation_count, output
+
+    def _reindex_observations(self) -> None:
+        """After compaction, inlines kept pointers whose target was summarized away and re-indexes the kept outputs."""
+        observe_turns = []
+        for index, message in enumerate(self.messages):
+            if message["role"] != "assistant":
+                continue
+            try:
+                payload = orjson.loads(message["content"])
+            except orjson.JSONDecodeError:
+                continue
+            if not isinstance(payload, dict) or payload.get("step") != "observe" or payload.get("summary"):
+                continue
+            if "observation" in payload:
+                entries = [(payload, "content")]
+            elif isinstance(payload.get("content"), list):
+                entries = [(entry, "output") for entry in payload["content"] if isinstance(entry, dict) and "observation" in entry]
+            else:
+                continue
+            observe_turns.append((index, payload, entries))
+        visible = {entry["observation"] for _, _, entries in observe_turns for entry, _ in entries}
+
+        texts, self._obs_texts, self._obs_hashes = self._obs_texts, {}, {}
+        for index, payload, entries in observe_turns:
+            changed = False
+            for entry, key in entries:
+                text = entry[key]
+                pointer = _OBSERVATION_POINTER.fullmatch(text) if isinstance(text, str) else None
+                if pointer is not None and int(pointer.group(1)) not in visible and int(pointer.group(1)) in texts:
+                    # Inline the original once; later repeats of it point at that kept copy instead
+                    original = texts[int(pointer.group(1))]
+                    first_kept = self._obs_hashes.get(_content_digest(original))
+                    text = entry[key] = original if first_kept is None else f"<identical to observation #{first_kept}>"
+                    changed = True
+                if isinstance(text, str) and len(text) >= 64 and _OBSERVATION_POINTER.fullmatch(text) is None:
+                    digest = _content_digest(text)
+                    if digest not in self._obs_hashes:
+                        self._obs_hashes[digest] = entry["observation"]
+                        self._obs_texts[entry["observation"]] = text
+            if changed:
+                self.messages[index] = {"role": "assistant", "content": _dumps(payload)}
+
+    def _append_assistant(self, step: str, payload: Union[Dict[str, Any], str]) -> None:
+        """Appends an assistant turn and records its step, so later checks never re-parse history.
+
+        `payload` is either the fields to serialize alongside `step` or an already-serialized message."""
+        content = payload if isinstance(payload, str) else _dumps({"step": step, **payload})
+        self.messages.append({"role": "assistant", "content": content})
+        self._last_step = step
+
+    async def _summarize_with_llm(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Asks the LLM for a concise summary of earlier turns. Returns None if the call fails."""
+        transcript = "\n".join(message["content"] for message in messages)
+        try:
+            await _OPENROUTER_RATE_LIMITER.acquire()
+            response = await self.client.chat.completions.create(
                 model=self.model,
-                messages=self.messages,
-                response_format={"type": "json_object"},
-                temperature=0.5, # Keep temp reasonable for reliable tool use
-                # max_tokens=1500 # Adjust if needed, but response_format helps
+                messages=[
+                    {"role": "system", "content": COMPACTION_PROMPT},
+                    {"role": "user", "content": transcript},
+                ],
+                temperature=0,
             )
-            response_content = response.choices[0].message.content
+            summary = response.choices[0].message.content
+        except Exception as e:
+            print(f"[CONTEXT] Summarization call failed ({e}); falling back to a step digest.")
+            return None
+        return summary.strip() if summary and summary.strip() else None
+
+    async def _maybe_compact(self, force: bool = False) -> None:
+        """Collapses older turns into one summary message once the estimated context exceeds its budget.
+
+        Compaction rewrites the cached prefix, so the next request re-establishes the cache breakpoints."""
+        # The system prompt, the user query and the most recent turns are kept verbatim
+        start = 2
+        end = len(self.messages) - self.keep_recent_messages
+        if end - start < 2:
+            return
+        older_messages = self.messages[start:end]
+        # ~4 characters per token is close enough to decide when to compact
+        estimated_tokens = sum(len(m["content"]) for m in self.messages) // 4
+        reclaimable_tokens = sum(len(m["content"]) for m in older_messages) // 4
+        if not force and estimated_tokens <= self.max_context_tokens * 0.7:
+            return
+        if not force and reclaimable_tokens < self.min_compaction_tokens:
+            # The budget is taken by what compaction cannot shrink; another summarization call would not help
+            return
+        summary = await self._summarize_with_llm(older_messages)
+        if summary is None:
+            summary = "\n".join(self._summarize_message(m) for m in older_messages)
+        summary = "Summary of earlier steps (details omitted to save context):\n" + summary
+        summary_message = {"role": "assistant", "content": _dumps({"step": "observe", "summary": True, "content": summary})}
+        self.messages[start:end] = [summary_message]
+        self._reindex_observations() # Summarized observations can no longer be pointed to
+        print(f"[CONTEXT] Compacted {end - start} messages (~{estimated_tokens} tokens of context) into a summary.")
+
+    @staticmethod
+    def _with_cache_control(message: Dict[str, str]) -> Dict[str, Any]:
+        """Returns a copy of a message as a content part carrying a prompt-cache breakpoint."""
+        return {"role": message["role"], "content": [{"type": "text", "text": message["content"], "cache_control": CACHE_CONTROL}]}
+
+    def _build_request_messages(self) -> List[Dict[str, Any]]:
+        """Builds the outgoing message list, marking the stable prefix with prompt-cache breakpoints.
+
+        History is append-only between compactions, so breakpoints go on the system prompt, the
+        user query (stable for the whole interaction) and the last turn before the newest two."""
+        last_stable = len(self.messages) - 3
+        breakpoints = {1, last_stable} if last_stable > 1 else {1}
+        request_messages: List[Dict[str, Any]] = [self._system_request_message]
+        request_messages.extend(
+            self._with_cache_control(message) if i in breakpoints else message
+            for i, message in enumerate(self.messages[1:], start=1)
+        )
+        return request_messages
+
+    async def _read_streamed_response(self, request_messages: List[Dict[str, Any]]) -> str:
+        """Streams the LLM response and stops reading once the top-level JSON object has been received."""
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=request_messages,
+            response_format=self.response_format,
+            temperature=self.temperature,
+            stream=True,
+        )
+        scanner = _JsonObjectScanner()
+        output_streamer = _OutputContentStreamer() if self.stream_final_output else None
+        parts: List[str] = []
+        checked_member_end = -1
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if output_streamer is not None:
+                    output_streamer.feed(delta)
+                if scanner.feed(delta):
+                    break # Anything after the object is discarded by the parser anyway
+                if (self.enable_speculative_tool_execution and self._speculative_call is None
+                        and scanner.member_end != checked_member_end):
+                    # A nested value (possibly "input") just closed; try to start the tool while the rest streams in
+                    checked_member_end = scanner.member_end
+                    self._maybe_start_speculative_call("".join(parts), scanner.member_end)
+        finally:
+            await stream.close()
+        self._final_output_streamed = output_streamer is not None and output_streamer.started
+        return "".join(parts)
+
+    def _maybe_start_speculative_call(self, partial_response: str, member_end: int) -> None:
+        """Launches the tool of a partially streamed action step once its 'function' and 'input' are known."""
+        json_start = partial_response.find('{')
+        try:
+            # Closing the object right after the last complete member yields a parseable prefix
+            partial_output, _ = _DECODER.raw_decode(partial_response[json_start:member_end] + "}")
+        except json.JSONDecodeError:
+            return
+        if not isinstance(partial_output, dict) or partial_output.get("step") != "action":
+            return
+        function_name = partial_output.get("function")
+        function_input = partial_output.get("input")
+        if not isinstance(function_name, str) or not isinstance(function_input, dict):
+            return
+        if function_name not in self._speculative_tools:
+            return
+        print(f"[SPECULATIVE] Starting '{function_name}' while the LLM response is still streaming.")
+        task = asyncio.create_task(self._execute_tool(function_name, function_input))
+        self._speculative_call = (function_name, function_input, task)
+
+    async def _take_speculative_result(self, function_name: Optional[str] = None, function_input: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Returns the result of a speculatively started call if it matches the final action, else None.
+
+        Called without arguments it settles a leftover call from a turn that did not act on it. A call that is
+        not returned is added to the history as an observation, since it did run."""
+        if self._speculative_call is None:
+            return None
+        speculative_name, speculative_input, task = self._speculative_call
+        self._speculative_call = None
+        output = await task # Always awaited: a started tool cannot be un-run
+        if function_name is not None and speculative_name == function_name and speculative_input == function_input:
+            return output
+        # The call ran without a matching action to report it; record it so the LLM knows it already happened
+        print(f"[SPECULATIVE] '{speculative_name}' ran but no matching action followed; adding its output as an observation.")
+        observation_id, output = self._record_observation(output)
+        self._append_assistant("observe", {
+            "observation": observation_id,
+            "content": f"Tool '{speculative_name}' was already run with input {_dumps(speculative_input)} while your previous response was streaming. Its output:\n{output}",
+        })
+        return None
+
+    def _response_cache_key(self) -> Optional[str]:
+        """Returns the cache key for the current request, or None when responses should not be cached."""
+        if not self.enable_response_cache or self.temperature != 0:
+            return None
+        # The system prompt (and therefore the tool set) enters the key through its precomputed digest
+        request = orjson.dumps(
+            {"model": self.model, "system": self._system_prompt_digest, "messages": self.messages[1:]},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(request).hexdigest()
+
+    async def _call_llm(self) -> Optional[Dict[str, Any]]:
+        """Calls the LLM, handles potential errors, and parses JSON response."""
+        print(f"\n[DEBUG] Sending {len(self.messages)} messages to LLM (model: {self.model}). Last message role: {self.messages[-1]['role']}")
+        # A speculative call left over from a turn that did not end in a matching action is settled first
+        await self._take_speculative_result()
+        self._final_output_streamed = False
+
+        cache_key = self._response_cache_key()
+        if cache_key is not None:
+            cached_content = self._response_cache.get(cache_key)
+            if cached_content is not None:
+                self.cache_stats["hits"] += 1
+                print(f"[CACHE] Reusing cached LLM response (hits: {self.cache_stats['hits']}, misses: {self.cache_stats['misses']}).")
+                cached_output = orjson.loads(cached_content)
+                self._append_assistant(cached_output["step"], cached_content)
+                return cached_output
+            self.cache_stats["misses"] += 1
+
+        try:
+            request_messages = self._build_request_messages()
+            await _OPENROUTER_RATE_LIMITER.acquire()
+            if self.stream:
+                response_content = await self._read_streamed_response(request_messages)
+            else:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=request_messages,
+                    response_format=self.response_format,
+                    temperature=self.temperature,
+                    # max_tokens=1500 # Adjust if needed, but response_format helps
+                )
+                response_content = response.choices[0].message.content
             if not response_content:
                  print("[ERROR] LLM returned empty content.")
-                 error_msg = {"role": "assistant", "content": json.dumps({"step": "observe", "content": "Error: LLM returned empty content. Please try again."})}
-                 self.messages.append(error_msg)
+                 self._append_assistant("observe", {"content": "Error: LLM returned empty content. Please try again."})
                  # Return an observation step so the agent loop can continue and potentially recover
                  return {"step": "observe", "content": "Error: LLM returned empty content."}
 
             try:
-            
+                # Decode the first JSON object in place; any surrounding prose is ignored
                 json_start = response_content.find('{')
-                json_end = response_content.rfind('}') + 1
-                if json_start != -1 and json_end != -1:
-                    potential_json = response_content[json_start:json_end]
-                    parsed_output = json.loads(potential_json)
-                else:
+                if json_start == -1:
                     raise json.JSONDecodeError("No JSON object found", response_content, 0)
-
-                # Basic validation
-                if "step" not in parsed_output:
-                     raise ValueError("Missing 'step' key in LLM response.")
-                if parsed_output["step"] == "action" and ("function" not in parsed_output or "input" not in parsed_output):
-                     raise ValueError("Malformed 'action' step: missing 'function' or 'input'.")
-
-                # Add the *original* (potentially slightly messy) response content to history
-                # This lets the LLM see if it included extra text it shouldn't have
-                self.messages.append({"role": "assistant", "content": response_content})
+                parsed_output, _ = _DECODER.raw_decode(response_content, json_start)
+                if not isinstance(parsed_output, dict):
+                    raise ValueError("LLM response is not a JSON object.")
+
+                # Older/unconstrained models sometimes send null or structured content; keep it instead of forcing a retry
+                content_value = parsed_output.get("content")
+                if "content" in parsed_output and content_value is None:
+                    parsed_output["content"] = "" # Keep the key: an observe step without content reads as a failed call
+                elif content_value is not None and not isinstance(content_value, str):
+                    parsed_output["content"] = _dumps(content_value)
+                # One pass over the precompiled step schema: step name, field types and per-step required fields
+                validation_error = _validate_agent_step(parsed_output)
+                if validation_error:
+                     raise ValueError(f"{validation_error} in LLM response.")
+
+                # Store a compact canonical form so earlier turns stay byte-identical for the prompt cache
+                canonical_content = _dumps(parsed_output)
+                if cache_key is not None:
+                    self._response_cache[cache_key] = canonical_content
+                self._append_assistant(parsed_output["step"], canonical_content)
                 return parsed_output
             except (json.JSONDecodeError, ValueError) as e:
                 print(f"[ERROR] Failed to parse or validate LLM JSON response: {e}\nResponse: {response_content}")
                 error_msg_content = f"Error: Invalid JSON response received: ```{response_content}```. Please provide output *strictly* in the required JSON format with all necessary keys ({e}). Only output the JSON object itself, nothing else."
-                error_msg = {"role": "assistant", "content": json.dumps({"step": "observe", "content": error_msg_content})}
-                self.messages.append(error_msg)
+                self._append_assistant("observe", {"content": error_msg_content})
                 return {"step": "observe", "content": "Error: Invalid JSON response received from LLM."}
 
         except APIError as e:
             print(f"[ERROR] API Error: {e}")
             error_msg_content = f"Error: API Error encountered: {e}. The request may need to be retried or modified."
-            error_msg = {"role": "assistant", "content": json.dumps({"step": "observe", "content": error_msg_content})}
-            self.messages.append(error_msg)
+            self._append_assistant("observe", {"content": error_msg_content})
             return {"step": "observe", "content": f"Error: API Error: {e}"}
         except Exception as e:
             print(f"[ERROR] Unexpected error during LLM call: {e}")
             error_msg_content = f"Error: An unexpected issue occurred: {e}. Please analyze the situation."
-            error_msg = {"role": "assistant", "content": json.dumps({"step": "observe", "content": error_msg_content})}
-            self.messages.append(error_msg)
+            self._append_assistant("observe", {"content": error_msg_content})
             return {"step": "observe", "content": f"Error: Unexpected error: {e}"}
 
 
-    def _execute_tool(self, function_name: str, function_input: Dict[str, Any]) -> str:
-        """Executes the specified tool function safely."""
-        print(f"\n[TOOL] Calling: {function_name} with params: {json.dumps(function_input)}")
-        if function_name in self.tools:
-            tool_info = self.tools[function_name]
-            tool_function = tool_info["fn"]
+    async def _execute_tool(self, function_name: str, function_input: Dict[str, Any]) -> str:
+        """Executes the specified tool function safely, keeping blocking tools off the event loop."""
+        print(f"\n[TOOL] Calling: {function_name} with params: {_dumps(function_input)}")
+        dispatch_entry = self._dispatch.get(function_name)
+        if dispatch_entry is not None:
+            tool_function, is_async, validator, max_tool_output_length = dispatch_entry
             try:
-                # Parameter validation
-                required_params = tool_info["parameters"].get("required", [])
-                for param in required_params:
-                    if param not in function_input:
-                        return f"Error: Missing required parameter '{param}' for tool '{function_name}'."
-
-                # Type validation (basic example)
-                properties = tool_info["parameters"].get("properties", {})
-                for param_name, param_data in properties.items():
-                    if param_name in function_input:
-                        expected_type = param_data.get("type")
-                        actual_value = function_input[param_name]
-                        if expected_type == "string" and not isinstance(actual_value, str):
-                            return f"Error: Invalid type for parameter '{param_name}'. Expected string, got {type(actual_value).__name__}."
-                        # Add more types (integer, boolean, object, array) if needed
-
-                output = tool_function(function_input)
+                # Parameter validation against the precompiled schema checker
+                if not isinstance(function_input, dict):
+                    return f"Error: Input for tool '{function_name}' must be a JSON object."
+                validation_error = validator(function_input)
+                if validation_error:
+                    return f"Error: {validation_error} for tool '{function_name}'."
+
+                if is_async:
+                    output = await tool_function(function_input)
+                else:
+                    output = await asyncio.to_thread(tool_function, function_input)
                 print(f"[TOOL OUTPUT]\n{output}")
-                # Limit output length before adding observation
-                max_tool_output_length = 5000
-                if len(output) > max_tool_output_length:
-                    output = output[:max_tool_output_length] + "\n... (tool output truncated)"
+                # Limit output length before adding observation, unless the tool bounds its own output;
+                # the full text is kept on disk so it can be fetched again on demand
+                if max_tool_output_length is not None and len(output) > max_tool_output_length:
+                    output = await asyncio.to_thread(_spill_observation, output, max_tool_output_length)
                 return output
             except Exception as e:
                 error_message = f"Error executing tool '{function_name}': {e}"
@@ -623,19 +1573,95 @@ class CodingAgent:
             print(f"[TOOL ERROR] {error_message}")
             return error_message
 
-    def run_interaction(self, user_query: str):
-        """Runs a full interaction cycle for a given user query."""
+    async def _execute_tool_calls(self, calls: List[Any]) -> List[Dict[str, Any]]:
+        """Runs a list of tool calls (concurrently if enabled) and returns their results in call order."""
+        async def run_call(call: Any) -> str:
+            if not isinstance(call, dict) or not call.get("function") or call.get("input") is None:
+                return "Error: Malformed call (each call needs 'function' and 'input')."
+            return await self._execute_tool(call["function"], call["input"])
+
+        if self.enable_parallel_tool_execution:
+            outputs = await asyncio.gather(*(run_call(call) for call in calls), return_exceptions=True)
+        else:
+            outputs = [await run_call(call) for call in calls]
+        results = []
+        for call, output in zip(calls, outputs):
+            if isinstance(output, BaseException):
+                output = f"Error executing tool call: {output}"
+            function_name = call.get("function") if isinstance(call, dict) else None
+            observation_id, output = self._record_observation(output)
+            results.append({"function": function_name, "observation": observation_id, "output": output})
+        return results
+
+    async def _execute_tool_dag(self, nodes: List[Any]) -> Union[str, List[Dict[str, Any]]]:
+        """Runs plan_dag nodes as soon as their dependencies finish; returns results in node order or an error."""
+        nodes_by_id: Dict[str, Dict[str, Any]] = {}
+        for node in nodes:
+            if (not isinstance(node, dict) or not isinstance(node.get("id"), str) or not node.get("function")
+                    or not isinstance(node.get("input"), dict) or not isinstance(node.get("deps", []), list)
+                    or not all(isinstance(dep, str) for dep in node.get("deps", []))):
+                return "Error: Every plan_dag node needs a string 'id', a 'function', an object 'input' and a list 'deps' of node ids."
+            if node["id"] in nodes_by_id:
+                return f"Error: Duplicate plan_dag node id '{node['id']}'."
+            nodes_by_id[node["id"]] = node
+        for node in nodes_by_id.values():
+            unknown = [dep for dep in node.get("deps", []) if dep not in nodes_by_id]
+            if unknown:
+                return f"Error: plan_dag node '{node['id']}' depends on unknown node(s): {', '.join(unknown)}."
+            # A placeholder naming another node is only filled reliably if that node is guaranteed to have
+            # finished first; "{x.result}" text that names no node (e.g. in source code) stays literal
+            undeclared = sorted((_placeholder_ids(node["input"]) & nodes_by_id.keys()) - set(node.get("deps", [])))
+            if undeclared:
+                return f"Error: plan_dag node '{node['id']}' uses the result of node(s) not listed in its 'deps': {', '.join(undeclared)}."
+
+        results: Dict[str, str] = {}
+        pending = dict(nodes_by_id)
+        running: Dict[asyncio.Task, str] = {}
+        while pending or running:
+            for node_id, node in list(pending.items()):
+                if not self.enable_parallel_tool_execution and running:
+                    break # Sequential mode: one ready node at a time, in dependency order
+                if all(dep in results for dep in node.get("deps", [])):
+                    del pending[node_id]
+                    tool_input = _fill_placeholders(node["input"], results)
+                    running[asyncio.create_task(self._execute_tool(node["function"], tool_input))] = node_id
+            if not running:
+                # Nothing can start: the remaining nodes wait on each other
+                for node_id in pending:
+                    results[node_id] = "Error: Not executed because its dependencies form a cycle."
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node_id = running.pop(task)
+                try:
+                    results[node_id] = task.result()
+                except Exception as e:
+                    results[node_id] = f"Error executing tool call: {e}"
+        dag_results = []
+        for node_id, node in nodes_by_id.items():
+            observation_id, output = self._record_observation(results[node_id])
+            dag_results.append({"id": node_id, "function": node["function"], "observation": observation_id, "output": output})
+        return dag_results
+
+    async def run_interaction(self, user_query: str) -> str:
+        """Runs a full interaction cycle for a given user query and returns the final output."""
         print(f"\n[USER QUERY] {user_query}")
         # Reset message history *except* for the system prompt for a new query
         self.messages = [self.messages[0]] # Keep only system prompt
         self.messages.append({"role": "user", "content": user_query})
+        self._last_step = None
+        self._observation_count = 0
+        self._obs_hashes = {}
+        self._obs_texts = {}
 
+        final_output = ""
         iteration_count = 0
         while iteration_count < self.max_iterations:
             iteration_count += 1
             print(f"\n--- Iteration {iteration_count}/{self.max_iterations} ---")
 
-            parsed_output = self._call_llm()
+            await self._maybe_compact(force=iteration_count == self.compact_after_iterations + 1)
+            parsed_output = await self._call_llm()
 
             # Handle case where LLM call failed critically or returned an observation directly
             if not parsed_output or parsed_output.get("step") == "observe":
@@ -644,7 +1670,8 @@ class CodingAgent:
                     print(f"[LLM/SYSTEM ERROR] {parsed_output['content']}")
                 else:
                      print("[AGENT] Failed to get valid action/plan/output from LLM. Aborting interaction.")
-                     self.messages.append({"role": "assistant", "content": json.dumps({"step":"output", "content":"Agent failed to get a valid response from the language model."})})
+                     final_output = "Agent failed to get a valid response from the language model."
+                     self._append_assistant("output", {"content": final_output})
                      break # Exit if LLM call fails critically
                 # If it was just an observation, let the loop continue so LLM can act on it
                 if parsed_output and parsed_output.get("step") == "observe":
@@ -672,56 +1699,108 @@ class CodingAgent:
                 if action_content:
                      print(f"             Action Rationale: {action_content}")
 
-                if not function_name or function_input is None:
-                    print("[ERROR] LLM action step missing 'function' or 'input'. Informing LLM.")
-                    obs_content = "Error: Your previous 'action' step was malformed (missing 'function' or 'input'). Please provide a valid action step with both fields in the correct JSON format."
-                    # Send back as an observation for LLM to correct itself
-                    self.messages.append({"role": "assistant", "content": json.dumps({"step": "observe", "content": obs_content})})
-                    continue # Let LLM retry
-
-                # Execute the tool
-                tool_output = self._execute_tool(function_name, function_input)
+                # Execute the tool, reusing the call started while the response was streaming if it matches
+                tool_output = await self._take_speculative_result(function_name, function_input)
+                if tool_output is None:
+                    tool_output = await self._execute_tool(function_name, function_input)
 
                 # Add the observation message for the LLM's next turn
-                observation_message = {"role": "assistant", "content": json.dumps({"step": "observe", "content": tool_output})}
-                self.messages.append(observation_message)
+                observation_id, tool_output = self._record_observation(tool_output)
+                self._append_assistant("observe", {"observation": observation_id, "content": tool_output})
                 print(f"[OBSERVATION ADDED] (Content length: {len(tool_output)})")
                 # Continue loop: LLM will process the observation next
 
+            elif step == "actions":
+                calls = parsed_output.get("calls", [])
+                if content:
+                     print(f"             Actions Rationale: {content}")
+                if not calls:
+                    obs_content = "Error: Your previous 'actions' step had no calls. Provide at least one {\"function\", \"input\"} object in 'calls'."
+                    self._append_assistant("observe", {"content": obs_content})
+                    continue # Let LLM retry
+
+                results = await self._execute_tool_calls(calls)
+                self._append_assistant("observe", {"content": results})
+                print(f"[OBSERVATION ADDED] ({len(results)} tool results, content length: {len(self.messages[-1]['content'])})")
+
+            elif step == "plan_dag":
+                if content:
+                     print(f"             Plan DAG Rationale: {content}")
+                dag_results = await self._execute_tool_dag(parsed_output.get("nodes", []))
+                self._append_assistant("observe", {"content": dag_results})
+                print(f"[OBSERVATION ADDED] (plan_dag results, content length: {len(self.messages[-1]['content'])})")
+
             # elif step == "observe": # Handled implicitly above - if _call_llm returns observe, we just loop
             #     print(f"[ANALYSIS/OBSERVE] {content}")
             #     continue
 
             elif step == "output":
-                print(f"\n[FINAL OUTPUT]\n{content}")
+                if not self._final_output_streamed: # Otherwise it was printed while streaming
+                    print(f"\n[FINAL OUTPUT]\n{content}")
+                final_output = content
                 # Interaction complete
                 break
 
-            else:
-                print(f"[ERROR] Unknown step type '{step}' received from LLM. Informing LLM.")
-                obs_content = f"Error: You provided an unknown step type '{step}'. Allowed steps are 'plan', 'action', 'output'. Please respond with a valid step in the correct JSON format."
-                self.messages.append({"role": "assistant", "content": json.dumps({"step": "observe", "content": obs_content})})
-                continue # Let LLM try to recover
+        await self._take_speculative_result() # Don't leave a tool running past the interaction
 
         if iteration_count >= self.max_iterations:
             print("\n[AGENT] Reached maximum iterations. Aborting interaction.")
             timeout_message_content = f"Reached maximum iterations ({self.max_iterations}). The task may be incomplete. Please review the steps or refine the request."
-            timeout_message = {"role": "assistant", "content": json.dumps({"step":"output", "content": timeout_message_content})}
             # Avoid double output if the last step was already output
-            last_msg = {}
-            try:
-                if self.messages[-1].get("role") == "assistant":
-                    last_msg = json.loads(self.messages[-1].get("content", "{}"))
-            except json.JSONDecodeError:
-                pass # Ignore malformed last message
-
-            if last_msg.get("step") != "output":
-                 self.messages.append(timeout_message)
+            if self._last_step != "output":
+                 self._append_assistant("output", {"content": timeout_message_content})
                  print(f"\n[FINAL OUTPUT]\n{timeout_message_content}")
+                 final_output = timeout_message_content
+
+        return final_output
+
+    async def run_batch(self, queries: List[str], concurrency: int = 10) -> List[str]:
+        """Runs independent queries concurrently, each in its own session, and returns their final outputs in order."""
+        semaphore = asyncio.Semaphore(concurrency)
+        self.client # Create this loop's API client up front so every session copy shares it
+
+        async def run_one(query: str) -> str:
+            # Sessions share configuration, the client's connection pool and the response cache,
+            # but each keeps its own history
+            session = copy.copy(self)
+            session.messages = [self.messages[0]]
+            session._speculative_call = None
+            session.stream_final_output = False # Concurrent answers would interleave on stdout
+            async with semaphore:
+                return await session.run_interaction(query)
+
+        outputs = await asyncio.gather(*(run_one(query) for query in queries), return_exceptions=True)
+        return [f"Error: {output}" if isinstance(output, BaseException) else output for output in outputs]
 
 
 # --- Main Execution ---
-if __name__ == "__main__":
+async def _ainput(prompt: str) -> str:
+    """Reads a line from stdin without blocking the event loop, so background tasks keep running."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result: Optional[str], error: Optional[BaseException]) -> None:
+        if future.done(): # Cancelled while the user was typing
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def read_line() -> None:
+        try:
+            line = input(prompt)
+        except BaseException as e: # EOFError etc. are re-raised in the awaiting coroutine
+            loop.call_soon_threadsafe(settle, None, e)
+        else:
+            loop.call_soon_threadsafe(settle, line, None)
+
+    # A daemon thread rather than the default executor, which would keep the process alive on Ctrl+C
+    threading.Thread(target=read_line, name="repl-input", daemon=True).start()
+    return await future
+
+
+async def main():
     print("Initializing AI Coding Agent...")
     # Ensure environment variable is loaded before initializing agent
     if not OPENROUTER_API_KEY:
@@ -739,26 +1818,38 @@ if __name__ == "__main__":
         exit(1)
 
 
-    while True:
-        try:
-            user_query = input("\nUser>> ")
-            if user_query.lower() in ['exit', 'quit']:
+    try:
+        while True:
+            try:
+                user_query = await _ainput("\nUser>> ")
+                if user_query.lower() in ['exit', 'quit']:
+                    break
+                if not user_query.strip():
+                    continue
+
+                # Start a new interaction cycle for the query
+                await agent.run_interaction(user_query)
+                print("\n[AGENT] Interaction complete or max iterations reached. Ready for next query.")
+
+            except KeyboardInterrupt:
+                print("\nExiting...")
                 break
-            if not user_query.strip():
-                continue
+            except EOFError:
+                print("\nInput stream closed. Exiting...")
+                break
+            except Exception as e:
+                print(f"\n[FATAL ERROR] An unexpected error occurred in the main loop: {e}")
+                # import traceback
+                # print(traceback.format_exc()) # Uncomment for full traceback
+                break
+    finally:
+        await agent.client.close()
 
-            # Start a new interaction cycle for the query
-            agent.run_interaction(user_query)
-            print("\n[AGENT] Interaction complete or max iterations reached. Ready for next query.")
 
-        except KeyboardInterrupt:
-            print("\nExiting...")
-            break
-        except EOFError:
-            print("\nInput stream closed. Exiting...")
-            break
-        except Exception as e:
-            print(f"\n[FATAL ERROR] An unexpected error occurred in the main loop: {e}")
-            # import traceback
-            # print(traceback.format_exc()) # Uncomment for full traceback
-            break
+if __name__ == "__main__":
+    # One event loop for the whole session so the client's pooled connections stay usable
+    run = getattr(uvloop, "run", None) or asyncio.run # uvloop.run needs uvloop 0.18+
+    try:
+        run(main())
+    except KeyboardInterrupt: # Ctrl+C while an interaction was awaiting the LLM or a tool
+        print("\nExiting...")